@@ -8,12 +8,77 @@
 import re
 import os
 import sys
+import json
+import hashlib
 import time
 import pymysql
+import contextlib
+import queue
+import shutil
+import threading
 import datetime
 import subprocess
+import http.client
+import urllib.request
+import concurrent.futures
 import pandas as pd
 
+# Compiled once at import, these are matched against every SRA number and every line of toolkit output
+_SRA_RE = re.compile(r"(?:SRR|ERR)[0-9]+") # i.e. SRR1568808, used with fullmatch
+_QUOTED_SRA_RE = re.compile(r"'([a-zA-Z0-9]+)'") # accession number as quoted in the toolkit output
+_QUOTED_SRA_FILE_RE = re.compile(r"'(?:[^']*/)?([a-zA-Z0-9]+)(?:\.sra)?'") # accession number or .sra file as quoted by vdb-validate
+_PREFETCH_VALID_RE = re.compile(r"'[a-zA-Z0-9]+' is valid", re.IGNORECASE) # prefetch's own validation of a download
+
+# Tool errors as (pattern, error code, retriever set collecting the SRA numbers, message), checked in order against
+# the first line of the tool output by check_proccess_output. New toolkit errors only need a new entry here.
+_TOOL_ERRORS = {
+    "vdb-dump": [
+        (re.compile(r"^(?=.* Access denied )(?=.* 403 )", re.IGNORECASE), 403, "prefetch_access_denied_sra",
+            "Error: Access denied for {sra_num}. (403)"),
+        (re.compile(r"^(?=.* failed to resolve accession )(?=.* 404 )", re.IGNORECASE), 404, "prefetch_access_failed_sra",
+            "Error: Failed to resolve accession number {sra_num}. (404)"),
+    ],
+    "prefetch": [
+        (re.compile(r"is larger than maximum allowed", re.IGNORECASE), 1101, "prefetch_oversize_sra",
+            "Error: {sra_num} exceeds the maximum allowed size of {max_size}. (1101)"),
+        (re.compile(r"failed to resolve accession", re.IGNORECASE), 404, "prefetch_access_failed_sra",
+            "Error: Failed to resolve accession number {sra_num}. (404)"),
+    ],
+}
+
+
+_error_time = (None, "") # (second, formatted time) of the last logged error
+
+
+def _format_error_time() -> str:
+    '''
+    Returns the current time as written to the error logs. The formatted time is cached and only reformatted
+    once the second changes, as errors are usually logged in bursts.
+
+    :return: the current time formatted as %Y-%m-%d %H:%M:%S
+    :rtype: str
+    '''
+    global _error_time
+    now = int(time.time())
+    if _error_time[0] != now:
+        _error_time = (now, datetime.datetime.fromtimestamp(now).strftime('%Y-%m-%d %H:%M:%S'))
+    return _error_time[1]
+
+
+def _is_validated_line(line: str) -> bool:
+    '''
+    Checks whether a vdb-validate output line reports a success ("... md5 ok", "... reads", "... is consistent").
+    Plain suffix comparisons are used instead of a regex as this runs on every line of the validator output.
+
+    :param line: a line of the vdb-validate output
+    :return: true if the line does not report an error
+    :rtype: boolean
+    '''
+    line = line.rstrip().lower()
+    if line.endswith(" ok"):
+        return len(line) > 3 and line[-4].isascii() and line[-4].isalnum()
+    return line.endswith((" reads", "is consistent"))
+
 class SequenceRetriever:
     '''
     Class responsible for retrieving the sequence data and verifying the validity of the .sra files
@@ -22,52 +87,338 @@ class SequenceRetriever:
     '''
 
     def __init__(self):
-        self.dir_path = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'SRA-Numbers') # log file path
-        self.sra_toolkit_path = '~/sra_toolkit/sratoolkit.2.11.0-centos_linux64/bin' # '../tools/sratoolkit.2.10.8/bin' # SRA Toolkit path
+        self._base_dir = os.path.dirname(os.path.realpath(__file__)) # directory of this script
+        self.dir_path = os.path.join(self._base_dir, 'SRA-Numbers') # log file path
+        self.sra_toolkit_path = os.path.expanduser('~/sra_toolkit/sratoolkit.2.11.0-centos_linux64/bin') # '../tools/sratoolkit.2.10.8/bin' # SRA Toolkit path
 
         self.output_dir = "raw_sequence_data" # sequence data output directory name
+        self._output_abs = os.path.join(self._base_dir, self.output_dir) # absolute path of the output directory
+        self.prefetch_dir = "prefetched_sra" # staging directory shared by all prefetched .sra files, removed after the run
+        self._prefetch_abs = os.path.join(self._base_dir, self.prefetch_dir) # absolute path of the staging directory
         self.errorLogFilename = "error-log.tsv"
+        self.errorLogFilenames = { # error code -> separate error log
+            "404": 'invalid-sra-log.tsv',
+            "403": 'private-sra-log.tsv',
+            "1101": 'oversize-sra-log.tsv',
+            "validation-failure": 'validation-error-log.tsv',
+            "1102": 'previously-retrieved-error.tsv',
+        }
         self.SRALogFilename = "sra-log"
 
+        self.max_prefetch_size = '70G' # in bytes (or with GB)
+        self.max_probe_workers = 8 # maximum number of concurrent vdb-dump calls
+        self.prefetch_batch_size = 10 # number of SRA numbers handed to a single prefetch call
+        self.max_prefetch_workers = 4 # maximum number of concurrent prefetch calls
+        self.max_dump_workers = 8 # maximum number of concurrent fasterq-dump processes
+        self.dump_threads = None # threads used by each fasterq-dump process, None gives each dump the cores not allocated to other dumps
+        self.dump_timeout = 12 * 60 * 60 # seconds before a hung fasterq-dump process is killed
+        self.dump_queue_size = 4 # maximum number of prefetched SRAs waiting for conversion
+        self.max_validate_workers = 8 # maximum number of concurrent vdb-validate processes
+        self.validate_batch_size = 10 # number of SRA numbers handed to a single vdb-validate call
+        self.validate_options = ["-I", "no"] # vdb-validate options, referential integrity checks are skipped
+        self.use_ena = False # download the .fastq.gz files from ENA where available instead of prefetching, enabled with --ena
+        self.max_ena_workers = 4 # maximum number of concurrent ENA downloads
+        self.ena_timeout = 60 # seconds without data before an ENA request is given up
+        self.ena_filereport_url = "https://www.ebi.ac.uk/ena/portal/api/filereport?accession={sra_num}&result=read_run&fields=fastq_ftp,fastq_md5&format=tsv"
+        self.use_probe_cache = True # skip the vdb-dump probe for SRAs recently found valid, disabled with --no-cache
+        self.probe_cache_ttl = 7 * 24 * 60 * 60 # seconds a cached vdb-dump result stays valid
+        self._probe_cache_path = os.path.join(self._base_dir, 'cache', 'vdb-dump.json') # on-disk vdb-dump results
+        self._probe_cache = self._load_probe_cache() # SRA number -> {"exit_status", "error_code", "decision", "ts"}
+
         self.data_hash_table = {}
 
-        self.prefetch_access_denied_sra = []
-        self.prefetch_access_failed_sra = []
-        self.previously_retrieved_sra = []
-        self.prefetch_oversize_sra = []
+        self.prefetch_access_denied_sra = set()
+        self.prefetch_access_failed_sra = set()
+        self.previously_retrieved_sra = set()
+        self.prefetch_oversize_sra = set()
+
+        self.past_sra = set()
+        self.validated_by_prefetch = set() # SRAs already reported as valid by prefetch, skipped by vdb-validate
+        self.ena_downloaded_sra = set() # SRAs downloaded as .fastq.gz from ENA, these have no .sra file
+
+        self._log_fds = {} # error log file name -> file descriptor opened in append mode
+        self._header_written = set() # error log files that already start with the header
+        self._db_conn = None # MySQL connection, opened on first use and reused until close()
+        self._allocated_dump_threads = 0 # fasterq-dump threads handed to the dumps currently running
+        self._dump_lock = threading.Lock() # guards _allocated_dump_threads
 
-        self.past_sra = []
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
 
 
 
     def download_data(self, sra_list: list):
         '''
         Download the raw sequence data from the corresponding SRA accession numbers using the SRA Toolkit.
+        Invalid or private SRA numbers are filtered out with vdb-dump first, the remaining ones are prefetched
+        in concurrent batches while the already prefetched ones are converted to .fastq files by the dump workers.
 
         :param sra_list: a list of SRA accession numbers to retrieve to raw sequence data of
         '''
-        for sra_num in sra_list:
+        good_list = []
+        cached_sra = {sra_num for sra_num in sra_list if self._cached_probe_ok(sra_num)}
+
+        # the vdb-dump calls mostly wait on NCBI, so they run concurrently while the results are classified in order here
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.max_probe_workers) as probe_pool:
+            probe_outputs = probe_pool.map(self.probe_sra, [sra_num for sra_num in sra_list if sra_num not in cached_sra])
+
+            for sra_num in sra_list:
+
+                if sra_num in cached_sra:
+                    print(f"Skipping vdb-dump for {sra_num}, found valid by a previous run.")
+                    good_list.append(sra_num)
+                    continue
+
+                print('\n\n')
+                # the errors are reported on the first line
+                exit_status, vdb_dump_output = next(probe_outputs)
+                first_line = vdb_dump_output[0] if len(vdb_dump_output) > 0 else ""
+                error_code = self.check_proccess_output(sra_num, "vdb-dump", first_line)
+
+                # only a clean exit without a known error is cached as valid, anything else is probed again next run
+                decision = "ok" if exit_status == 0 and error_code == -1 else "error"
+                self._probe_cache[sra_num] = {"exit_status": exit_status, "error_code": error_code, "decision": decision, "ts": time.time()}
+                if error_code == -1:
+                    for line in vdb_dump_output:
+                        print(line)
+                    good_list.append(sra_num)
+        self._save_probe_cache()
+
+        os.makedirs(self.output_dir, exist_ok=True)
+
+        # the SRAs ENA does not serve fall back to prefetch and fasterq-dump
+        if self.use_ena == True:
+            with concurrent.futures.ThreadPoolExecutor(max_workers=self.max_ena_workers) as ena_pool:
+                for sra_num, downloaded in zip(good_list, ena_pool.map(self.download_from_ena, good_list)):
+                    if downloaded == True:
+                        self.ena_downloaded_sra.add(sra_num)
+            print(f"\nDownloaded {len(self.ena_downloaded_sra)}/{len(good_list)} SRA numbers from ENA")
+            good_list = [sra_num for sra_num in good_list if sra_num not in self.ena_downloaded_sra]
+
+        dump_queue = queue.Queue(maxsize=self.dump_queue_size)
+        dump_workers = min(self.max_dump_workers, os.cpu_count() or 1)
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=dump_workers) as dump_pool:
+            for _ in range(dump_workers):
+                dump_pool.submit(self.dump_worker, dump_queue)
+
+            try:
+                sra_batches = [good_list[start:start + self.prefetch_batch_size] for start in range(0, len(good_list), self.prefetch_batch_size)]
+                with concurrent.futures.ThreadPoolExecutor(max_workers=self.max_prefetch_workers) as prefetch_pool:
+                    futures = [prefetch_pool.submit(self.prefetch_batch, sra_batch) for sra_batch in sra_batches]
+
+                    # a batch is handed to the dump workers as soon as its prefetch call returns
+                    for batch_num, future in enumerate(concurrent.futures.as_completed(futures)):
+                        prefetched_sra = future.result()
+                        print(f"\nPrefetched batch {batch_num + 1}/{len(sra_batches)} ({len(prefetched_sra)} SRA numbers ready for conversion)")
+                        for sra_num in prefetched_sra:
+                            dump_queue.put(sra_num)
+            finally:
+                # one sentinel per worker so that every worker exits once the queue is drained
+                for _ in range(dump_workers):
+                    dump_queue.put(None)
+
+
+    def dump_worker(self, dump_queue: queue.Queue):
+        '''
+        Converts prefetched .sra files to .fastq files with fasterq-dump. Keeps taking SRA numbers from the
+        queue until a None sentinel is received. Unless dump_threads is set, each dump gets the cores that are
+        not allocated to the dumps already running (at least one), and gives them back when it finishes. A dump
+        running on its own uses every core, and the total only exceeds the core count by the one-thread minimum.
+
+        :param dump_queue: queue containing the prefetched SRA numbers to be converted
+        '''
+        while True:
+            sra_num = dump_queue.get()
+            if sra_num == None:
+                break
 
-            curr_time = time.strftime("%Y-%m-%d|%H:%M:%S")
+            with self._dump_lock:
+                dump_threads = self.dump_threads or max(1, (os.cpu_count() or 1) - self._allocated_dump_threads)
+                self._allocated_dump_threads += dump_threads
 
-            print('\n\n')
-            vdb_dump_output = subprocess.getoutput(f"{self.sra_toolkit_path}/vdb-dump --info {sra_num}")
-            if self.check_proccess_output(sra_num, "vdb-dump", vdb_dump_output) == -1:
-                for line in vdb_dump_output.split('\n'):
-                    print(line)
-            else: continue
+            print(f"Converting {sra_num}.sra to {sra_num}.fastq...")
+            try:
+                # the output is not captured, fasterq-dump writes its progress straight to the terminal
+                subprocess.run([f"{self.sra_toolkit_path}/fasterq-dump", "--split-3", "-e", str(dump_threads),
+                                "-t", self.output_dir, "-O", os.path.join(self.output_dir, sra_num),
+                                self.sra_file(sra_num), "-p"], stdout=None, stderr=None, timeout=self.dump_timeout)
+            except subprocess.TimeoutExpired:
+                print(f"Error: fasterq-dump for {sra_num} did not finish within {self.dump_timeout} seconds and was stopped.")
+            except OSError as e:
+                print(f"Error: fasterq-dump failed to start for {sra_num}: {e}")
+            finally:
+                with self._dump_lock:
+                    self._allocated_dump_threads -= dump_threads
+
+
+    def prefetch_batch(self, sra_batch: list) -> list:
+        '''
+        Prefetch a batch of SRA accession numbers with a single prefetch call. The prefetch output is shown and
+        parsed line by line as it is produced to find the SRA numbers that were skipped (oversize) or failed to resolve.
 
-            max_prefetch_size = '70G' # in bytes (or with GB)
-            subprocess.run(f"{self.sra_toolkit_path}/prefetch -p {sra_num} -X {max_prefetch_size}", shell=True)
+        :param sra_batch: a list of SRA accession numbers to be prefetched together
+        :return: a list containing the successfully prefetched SRA numbers
+        :rtype: list
+        '''
+        failed_sra = set()
+        for line in self.stream_sra_tool("prefetch", "-p", "-X", self.max_prefetch_size, "-O", self._prefetch_abs, *sra_batch):
+            print(line)
 
-            # check if the prefetched .sra file exist (if not, then it might have exceeded the max-size requirement)
-            if sra_num not in os.listdir():
-                self.prefetch_oversize_sra.append(sra_num)
+            accession = _QUOTED_SRA_RE.search(line)
+            if accession == None or accession.group(1) not in sra_batch or accession.group(1) in failed_sra:
                 continue
+            if _PREFETCH_VALID_RE.search(line) != None:
+                self.validated_by_prefetch.add(accession.group(1))
+            elif self.check_proccess_output(accession.group(1), "prefetch", line) != -1:
+                failed_sra.add(accession.group(1))
 
-            print(f"Converting {sra_num}.sra to {sra_num}.fastq...")
-            subprocess.run(f"{self.sra_toolkit_path}/fasterq-dump --split-3 -O {self.output_dir}/{sra_num} \
-                ./{sra_num}/{sra_num}.sra -p", shell=True)
+        return [sra_num for sra_num in sra_batch if sra_num not in failed_sra]
+
+
+    def download_from_ena(self, sra_num: str) -> bool:
+        '''
+        Downloads the .fastq.gz files ENA generated for a SRA number into its output folder, skipping prefetch and
+        fasterq-dump. The file locations and checksums are looked up with ENA's file report, the files are streamed
+        to disk and only kept if their MD5 matches.
+
+        :param sra_num: SRA number to be downloaded
+        :return: true if every file was downloaded and false if the SRA number has to be prefetched instead
+        :rtype: boolean
+        '''
+        try:
+            with urllib.request.urlopen(self.ena_filereport_url.format(sra_num=sra_num), timeout=self.ena_timeout) as response:
+                report = response.read().decode("utf-8").splitlines()
+        except (OSError, http.client.HTTPException, ValueError) as e:
+            print(f"ENA file report for {sra_num} is not available ({e}), falling back to prefetch.")
+            return False
+
+        # the report is a header line followed by one line per run, fastq_ftp and fastq_md5 hold ;-separated values
+        if len(report) < 2:
+            return False
+        fields = dict(zip(report[0].split("\t"), report[1].split("\t")))
+        paths = [path for path in fields.get("fastq_ftp", "").split(";") if len(path) > 0]
+        checksums = [md5 for md5 in fields.get("fastq_md5", "").split(";") if len(md5) > 0]
+        if len(paths) == 0 or len(paths) != len(checksums):
+            return False
+
+        sra_output = os.path.join(self.output_dir, sra_num)
+        os.makedirs(sra_output, exist_ok=True)
+        downloaded = []
+        for path, md5 in zip(paths, checksums):
+            url = f"https://{path}"
+            fastq_path = os.path.join(sra_output, os.path.basename(path))
+            try:
+                digest = hashlib.md5()
+                with urllib.request.urlopen(url, timeout=self.ena_timeout) as response, open(f"{fastq_path}.part", "wb") as file_ptr:
+                    for chunk in iter(lambda: response.read(1 << 20), b""):
+                        digest.update(chunk)
+                        file_ptr.write(chunk)
+                if digest.hexdigest() != md5.lower():
+                    raise ValueError(f"MD5 {digest.hexdigest()} does not match {md5}")
+                os.replace(f"{fastq_path}.part", fastq_path)
+                downloaded.append(fastq_path)
+            except (OSError, http.client.HTTPException, ValueError) as e:
+                print(f"ENA download of {url} failed ({e}), falling back to prefetch.")
+                # the files already downloaded for this SRA are removed as well, fasterq-dump writes the whole set again
+                for leftover in [f"{fastq_path}.part", *downloaded]:
+                    with contextlib.suppress(OSError):
+                        os.remove(leftover)
+                return False
+
+        print(f"Downloaded {sra_num} from ENA ({len(paths)} files)")
+        return True
+
+
+    def sra_file(self, sra_num: str) -> str:
+        '''
+        Returns the path of the .sra file prefetched for a SRA number.
+
+        :param sra_num: SRA number of the file
+        :return: the path of the .sra file inside the staging directory
+        :rtype: str
+        '''
+        return os.path.join(self._prefetch_abs, sra_num, f"{sra_num}.sra")
+
+
+    def probe_sra(self, sra_num: str) -> tuple:
+        '''
+        Runs vdb-dump --info on a single SRA number.
+
+        :param sra_num: SRA number to look up
+        :return: a tuple of the vdb-dump exit status and its output lines, starting at the first non-empty line
+        :rtype: tuple
+        '''
+        result = subprocess.run([f"{self.sra_toolkit_path}/vdb-dump", "--info", sra_num],
+                                stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True)
+        output = result.stdout.rstrip('\n').split('\n')
+        first = next((i for i, line in enumerate(output) if len(line.strip()) > 0), len(output))
+        return result.returncode, output[first:]
+
+
+    def _load_probe_cache(self) -> dict:
+        '''
+        Loads the vdb-dump results of previous runs. A missing or unreadable cache file gives an empty cache.
+
+        :return: the cached vdb-dump results keyed by SRA number
+        :rtype: dict
+        '''
+        try:
+            with open(self._probe_cache_path, "r", encoding="utf-8") as file_ptr:
+                return json.load(file_ptr)
+        except (OSError, ValueError):
+            return {}
+
+
+    def _save_probe_cache(self):
+        '''
+        Writes the vdb-dump results back to the cache file. The file is replaced atomically so that an
+        interrupted run does not leave a truncated cache behind.
+        '''
+        os.makedirs(os.path.dirname(self._probe_cache_path), exist_ok=True)
+        tmp_path = f"{self._probe_cache_path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as file_ptr:
+            json.dump(self._probe_cache, file_ptr)
+        os.replace(tmp_path, self._probe_cache_path)
+
+
+    def _cached_probe_ok(self, sra_num: str) -> bool:
+        '''
+        Checks whether vdb-dump found the SRA number valid within the cache TTL. Entries without an exit status,
+        written before it was recorded, are probed again.
+
+        :param sra_num: SRA number to look up
+        :return: true if the vdb-dump probe can be skipped
+        :rtype: boolean
+        '''
+        if self.use_probe_cache == False:
+            return False
+        entry = self._probe_cache.get(sra_num)
+        return entry != None and entry.get("decision") == "ok" and entry.get("exit_status") == 0 \
+            and time.time() - entry.get("ts", 0) < self.probe_cache_ttl
+
+
+    def stream_sra_tool(self, tool: str, *args):
+        '''
+        Runs one of the SRA Toolkit programs directly (without a shell) and yields its output line by line
+        as it is produced, without buffering the whole output in memory. Closing the generator early kills the program.
+
+        :param tool: name of the SRA Toolkit program (i.e. vdb-validate)
+        :param args: arguments to be passed to the program
+        '''
+        with subprocess.Popen([f"{self.sra_toolkit_path}/{tool}", *args],
+                              stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True, bufsize=1) as process:
+            try:
+                for line in process.stdout:
+                    yield line.rstrip('\n')
+            except GeneratorExit:
+                process.kill() # the caller stopped reading, the program is not left running in the background
+                raise
 
 
     def verify_sra_format(self, sra_input: list) -> list:
@@ -83,9 +434,7 @@ class SequenceRetriever:
         incorrect_data = []
 
         for sra_num in sra_input:
-            sra_num = sra_num.strip().replace('\n', '')
-
-            if re.match("^(SRR|ERR)[0-9]+$", sra_num.upper()): # i.e. SRR1568808
+            if _SRA_RE.fullmatch(sra_num.upper()) != None:
                 correct_data.append(sra_num)
             else:
                 incorrect_data.append(sra_num)
@@ -101,25 +450,31 @@ class SequenceRetriever:
 
     def validate_sra_data(self, sra_input_list: list) -> bool:
         '''
-        Validates the downloaded .sra files using the SRA Toolkit. Errors will be logged.
+        Validates the downloaded .sra files using the SRA Toolkit. The SRA numbers are validated in batches by concurrent
+        vdb-validate calls, their results are processed and logged as they complete. Files already validated by prefetch
+        are not read again. Errors will be logged.
 
         :param sra_input_list: a list of SRA numbers to be validated
         :return: false if any data failed to be validated and true otherwise
         :rtype: boolean
         '''
         errors = []
+        failed_records = []
         validation = True
 
-        for sra_num in self.progress_bar(sra_input_list, prefix="Validating SRA Data: ", bar_length=50):
-            result = subprocess.getoutput(f'{self.sra_toolkit_path}/vdb-validate {sra_num}')
-            result = result.split('\n')
-
-            for line in result:
-                if re.search("[a-zA-Z0-9] ok$", line, re.IGNORECASE) != None \
-                    or re.search(" reads$", line, re.IGNORECASE) != None \
-                    or re.search("is consistent$", line, re.IGNORECASE) != None:
-                    continue
-                else:
+        validate_workers = min(self.max_validate_workers, os.cpu_count() or 1)
+        with concurrent.futures.ThreadPoolExecutor(max_workers=validate_workers) as validate_pool:
+            sra_to_validate = [sra_num for sra_num in sra_input_list
+                               if sra_num not in self.validated_by_prefetch and sra_num not in self.ena_downloaded_sra]
+            futures = [validate_pool.submit(self._validate_batch, sra_to_validate[start:start + self.validate_batch_size])
+                       for start in range(0, len(sra_to_validate), self.validate_batch_size)]
+
+            # logging stays on this thread, the workers only run vdb-validate. The bar advances by SRA number, a whole
+            # batch at a time as each vdb-validate call completes
+            results = (result for future in concurrent.futures.as_completed(futures) for result in future.result())
+            for sra_num, failed_lines in self.progress_bar(results, prefix="Validating SRA Data: ",
+                                                           bar_length=50, count=len(sra_to_validate)):
+                for line in failed_lines:
                     err = ""
                     if sra_num in self.prefetch_access_denied_sra:
                         err = "Project is private: Access Denied (403)"
@@ -142,7 +497,9 @@ class SequenceRetriever:
                         errors.append(f'Error Not Caught: Data {sra_num} validation failed. Error: {err}')
 
                     validation = False
-                    self.log_error(sra_num, err, "validation-failure")
+                    failed_records.append((sra_num, err))
+
+        self.log_errors(failed_records, "validation-failure")
 
         for e in errors:
             print(e)
@@ -150,6 +507,47 @@ class SequenceRetriever:
         return validation
 
 
+    def _validate_batch(self, sra_batch: list) -> list:
+        '''
+        Runs a single vdb-validate call on a batch of SRA numbers. Failed output lines are matched to their SRA number
+        through the accession quoted in the line. If any failed line cannot be matched, the batch is validated again
+        one SRA number at a time.
+
+        :param sra_batch: a list of SRA numbers to be validated together
+        :return: a list of (SRA number, list of its failed output lines) tuples
+        :rtype: list
+        '''
+        failed_lines = {sra_num: [] for sra_num in sra_batch}
+
+        sra_files = [self.sra_file(sra_num) for sra_num in sra_batch]
+        validate_output = self.stream_sra_tool("vdb-validate", *self.validate_options, *sra_files)
+        for line in validate_output:
+            if _is_validated_line(line):
+                continue
+
+            accession = next((token for token in _QUOTED_SRA_FILE_RE.findall(line) if token in failed_lines), None)
+            if accession == None:
+                # the batch call is stopped before the files are read again one at a time
+                validate_output.close()
+                return [self._validate_one(sra_num) for sra_num in sra_batch]
+            failed_lines[accession].append(line)
+
+        return list(failed_lines.items())
+
+
+    def _validate_one(self, sra_num: str) -> tuple:
+        '''
+        Runs vdb-validate on a single SRA number and collects the output lines that do not report a success.
+
+        :param sra_num: SRA number to be validated
+        :return: a tuple of the SRA number and the list of its failed output lines
+        :rtype: tuple
+        '''
+        failed_lines = [line for line in self.stream_sra_tool("vdb-validate", *self.validate_options, self.sra_file(sra_num))
+                        if not _is_validated_line(line)]
+        return sra_num, failed_lines
+
+
     def check_proccess_output(self, sra_num: str, process: str, process_output: str) -> int:
         '''
         Function for identifying the process's error. Determines whether a vdb-dump failure is caused by invalid
@@ -165,28 +563,16 @@ class SequenceRetriever:
         '''
         process_output = process_output.strip().split('\n')
 
-        if process == "vdb-dump":
-            if re.search(" Access denied ", process_output[0], re.IGNORECASE) != None \
-                and re.search("( 403 )", process_output[0], re.IGNORECASE) != None:
-
-                print(f'Error: Access denied for {sra_num}. (403)')
-                self.prefetch_access_denied_sra.append(sra_num)
-                return 403
-
-            elif re.search(" failed to resolve accession ", process_output[0], re.IGNORECASE) != None \
-                and re.search("( 404 )", process_output[0], re.IGNORECASE) != None:
-
-                print(f'Error: Failed to resolve accession number {sra_num}. (404)')
-                self.prefetch_access_failed_sra.append(sra_num)
-                return 404
-
-        elif process == 'prefetch':
-            if re.search("is larger than maximum allowed: skipped", process_output[1], re.IGNORECASE) != None:
-                return 1101
+        if process in _TOOL_ERRORS:
+            for error_re, error_code, error_set, error_message in _TOOL_ERRORS[process]:
+                if error_re.search(process_output[0]) != None:
+                    print(error_message.format(sra_num=sra_num, max_size=self.max_prefetch_size))
+                    getattr(self, error_set).add(sra_num)
+                    return error_code
 
         elif process == 'previously_retrieved':
             if sra_num in self.past_sra:
-                self.previously_retrieved_sra.append(sra_num)
+                self.previously_retrieved_sra.add(sra_num)
                 return 1102
 
         elif process == "fasterq-dump":
@@ -204,101 +590,152 @@ class SequenceRetriever:
         :param error_message: a message explaining what the error is (the error generated by a certain command)
         :param error_id: error code/name used to identify the error
         '''
+        self.log_errors([(sra_num, error_message)], error_id)
+
+
+    def log_errors(self, error_records: list, error_id: str):
+        '''
+        Log a batch of errors sharing the same error code to the correspounding files. Each log file
+        receives the whole batch in a single append-mode os.write, so concurrent writers cannot interleave
+        within it. A short write is completed by _write_all.
+
+        :param error_records: a list of (SRA accession number, error message) tuples
+        :param error_id: error code/name used to identify the errors
+        '''
+        if len(error_records) == 0:
+            return
+
+        errorTime = _format_error_time()
+        records = "".join("\t".join((errorTime, sra_num, *map(str, self.data_hash_table[sra_num]), error_message)) + "\n"
+                          for sra_num, error_message in error_records).encode("utf-8")
+
         # Default Error Log (all errors will be logged)
-        with open(os.path.join(self.dir_path, self.errorLogFilename), "a+", encoding="utf-8") as file_ptr:
-            label = "Error_Time\tSRA_Accession_Number\tProject_ID\tUser_ID\tError_Reason\n"
-            file_ptr.seek(0)
-            firstline = file_ptr.readline()
-            if firstline != label:
-                file_ptr.write(label)
-
-            errorTime = datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-            file_ptr.write(f"{errorTime}\t{sra_num}\t")
-            for data in self.data_hash_table[sra_num]:
-                file_ptr.write(f"{data}\t")
-            file_ptr.write(f'{error_message}\n')
+        self._write_all(self._get_log(self.errorLogFilename), records)
 
         # Separate Error Log
-        error_log_file = ""
-        if error_id == "404":
-            error_log_file = 'invalid-sra-log.tsv'
-        elif error_id == "403":
-            error_log_file = 'private-sra-log.tsv'
-        elif error_id == "1101":
-            error_log_file = 'oversize-sra-log.tsv'
-        elif error_id == 'validation-failure':
-            error_log_file = 'validation-error-log.tsv'
-        elif error_id == '1102':
-            error_log_file = 'previously-retrieved-error.tsv'
-        else: print(f'Error >{error_message}({error_id})< for SRA {sra_num} will not be reflected in any distinct error log files. Please visit "{self.errorLogFilename}" for the error.')
+        error_log_file = self.errorLogFilenames.get(error_id, "")
+        if len(error_log_file) == 0:
+            for sra_num, error_message in error_records:
+                print(f'Error >{error_message}({error_id})< for SRA {sra_num} will not be reflected in any distinct error log files. Please visit "{self.errorLogFilename}" for the error.')
 
         if len(error_log_file) > 0:
-            with open(os.path.join(self.dir_path, error_log_file), "a+", encoding="utf-8") as file_ptr:
-                label = "Error_Time\tSRA_Accession_Number\tProject_ID\tUser_ID\tError_Reason\n"
-                file_ptr.seek(0)
-                firstline = file_ptr.readline()
-                if firstline != label:
-                    file_ptr.write(label)
+            self._write_all(self._get_log(error_log_file), records)
+
 
-                errorTime = datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-                file_ptr.write(f"{errorTime}\t{sra_num}\t")
-                for data in self.data_hash_table[sra_num]:
-                    file_ptr.write(f"{data}\t")
-                file_ptr.write(f'{error_message}\n')
+    def _write_all(self, log_fd: int, data: bytes):
+        '''
+        Writes all of the data to a file descriptor. os.write may write only part of the data (i.e. when interrupted
+        by a signal), the rest is written by further calls.
+
+        :param log_fd: file descriptor to write to
+        :param data: bytes to be written
+        '''
+        data = memoryview(data)
+        while len(data) > 0:
+            written = os.write(log_fd, data)
+            if written == 0:
+                raise OSError(f"Error log write stopped with {len(data)} bytes left to write")
+            data = data[written:]
+
+
+    def _get_log(self, log_filename: str):
+        '''
+        Returns the file descriptor of an error log file. The file is opened with O_APPEND on first use and kept
+        open until close() is called. The header is written the first time a file without one is used.
+
+        :param log_filename: name of the error log file inside the log directory
+        :return: the file descriptor of the error log
+        :rtype: int
+        '''
+        if log_filename not in self._log_fds:
+            self._log_fds[log_filename] = os.open(os.path.join(self.dir_path, log_filename), os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+            if os.fstat(self._log_fds[log_filename]).st_size > 0:
+                self._header_written.add(log_filename)
+
+        if log_filename not in self._header_written:
+            self._write_all(self._log_fds[log_filename], b"Error_Time\tSRA_Accession_Number\tProject_ID\tUser_ID\tError_Reason\n")
+            self._header_written.add(log_filename)
+
+        return self._log_fds[log_filename]
+
+
+    def close(self):
+        '''
+        Closes all error log files and the database connection opened by the retriever.
+        '''
+        for log_fd in self._log_fds.values():
+            os.close(log_fd)
+        self._log_fds.clear()
+
+        if self._db_conn != None:
+            self._db_conn.close()
+            self._db_conn = None
 
 
     def read_SRA_log(self):
         '''
-        Reads the SRA accession number log file and stores the data in a hash table.
+        Reads the SRA accession number log file and stores the data in a hash table. The SRA numbers and their
+        data are stripped here once, so the rest of the retriever can use them as they are.
         '''
         with open(os.path.join(self.dir_path, self.SRALogFilename), "r", encoding="utf-8") as file_ptr:
-            content = file_ptr.readlines()
-            for line in content:
-                values = line.replace("\n", "").split("\t")
-                self.data_hash_table[values[0].strip()] = values[1:len(values)]
+            for line in file_ptr:
+                values = line.rstrip("\n").split("\t")
+                self.data_hash_table[values[0].strip()] = tuple(value.strip() for value in values[1:])
 
 
-    def cleanup_files(self, sra_data: dict):
+    def cleanup_files(self):
         '''
-        Removes all redundant .sra files that are no longer needed. Failed removal will be logged accordingly.
-
-        :param sra_data: dictionary containing the sra data (including the sra numbers)
+        Removes all redundant .sra files that are no longer needed, together with the prefetch staging directory.
+        Failed removal will be logged accordingly.
         '''
         errors = []
 
-        for sra_num in self.progress_bar(sra_data, prefix="Cleaning Up Redundant Files: ", bar_length=50):
-            sra_num = sra_num.strip().replace('\n', '')
-
-            # Failed SRA prefetch does not create a empty file
-            if sra_num in self.prefetch_access_failed_sra or sra_num in self.prefetch_access_denied_sra or sra_num in self.prefetch_oversize_sra:
-                continue
+        # every prefetched .sra file is in the staging directory, which is removed as a whole
+        failed_removals = set()
+        def on_error(function, path, exc):
+            if not isinstance(exc, FileNotFoundError): # nothing was prefetched
+                failed_removals.add(os.path.relpath(path, self._prefetch_abs).split(os.sep)[0])
 
-            file_removal = subprocess.getoutput(f'rm {os.path.dirname(os.path.realpath(__file__))}/{sra_num}/{sra_num}.sra')
-            dir_removal = subprocess.getoutput(f'rmdir {os.path.dirname(os.path.realpath(__file__))}/{sra_num}')
+        print("Cleaning Up Redundant Files...")
+        if sys.version_info >= (3, 12):
+            shutil.rmtree(self._prefetch_abs, onexc=on_error)
+        else: # onerror is deprecated from 3.12 and gets the exc_info tuple instead of the exception
+            shutil.rmtree(self._prefetch_abs, onerror=lambda function, path, exc_info: on_error(function, path, exc_info[1]))
 
-            if len(file_removal) > 0 or len(dir_removal) > 0:
+        for sra_num in sorted(failed_removals):
+            if sra_num in self.data_hash_table:
                 errors.append(f"Removal for {sra_num}.sra failed.")
                 error_message = f"{sra_num}.sra and/or the folder containing this file failed to be removed."
                 self.log_error(sra_num, error_message, "-1")
-
+            elif sra_num == os.curdir:
+                errors.append(f"Removal of the prefetch directory {self._prefetch_abs} failed.")
 
         if len(self.prefetch_access_denied_sra) > 0:
-            for sra_num in self.prefetch_access_denied_sra:
-                empty_folder_removal = subprocess.getoutput(f'rmdir {os.path.dirname(os.path.realpath(__file__))}/{self.output_dir}/{sra_num}')
+            for sra_num in sorted(self.prefetch_access_denied_sra):
+                try:
+                    os.rmdir(os.path.join(self._output_abs, sra_num))
+                except OSError:
+                    pass # the output folder is only created for some failures
 
                 error_message = "Incorrect SRA: access denied (403)"
                 self.log_error(sra_num, error_message, "403")
 
         if len(self.prefetch_access_failed_sra) > 0:
-            for sra_num in self.prefetch_access_failed_sra:
-                empty_folder_removal = subprocess.getoutput(f'rmdir {os.path.dirname(os.path.realpath(__file__))}/{self.output_dir}/{sra_num}')
+            for sra_num in sorted(self.prefetch_access_failed_sra):
+                try:
+                    os.rmdir(os.path.join(self._output_abs, sra_num))
+                except OSError:
+                    pass # the output folder is only created for some failures
 
                 error_message = "Incorrect SRA: failed to resolve accession (404)"
                 self.log_error(sra_num, error_message, "404")
 
         if len(self.prefetch_oversize_sra) > 0:
-            for sra_num in self.prefetch_oversize_sra:
-                empty_folder_removal = subprocess.getoutput(f'rmdir {os.path.dirname(os.path.realpath(__file__))}/{self.output_dir}/{sra_num}')
+            for sra_num in sorted(self.prefetch_oversize_sra):
+                try:
+                    os.rmdir(os.path.join(self._output_abs, sra_num))
+                except OSError:
+                    pass # the output folder is only created for some failures
 
                 error_message = "SRA exceeds the maximum allowed size (1101)"
                 self.log_error(sra_num, error_message, "1101")
@@ -307,7 +744,7 @@ class SequenceRetriever:
             print(e)
 
 
-    def progress_bar(self, input, prefix="", suffix="", suffix_control=False, bar_length=50, file=sys.stdout):
+    def progress_bar(self, input, prefix="", suffix="", suffix_control=False, bar_length=50, file=sys.stdout, count=None, min_interval=0.1):
         '''Light-weight progress bar (generator)
 
         :param input: list/range input to be iterated over
@@ -316,19 +753,32 @@ class SequenceRetriever:
         :param suffix control: boolean to whether the suffix should be printed
         :param bar_length: the progress bar's length
         :param file: display/storage method
+        :param count: number of items in the input, required when the input has no len() (i.e. a generator)
+        :param min_interval: minimum number of seconds between two redraws that only update the counter
         '''
 
-        count = len(input)
-        def show(curr):
-            filled_length = int(bar_length * curr / count)
+        if count == None:
+            count = len(input)
 
-            filled = filled_length * '#'
-            unfilled = (bar_length - filled_length) * ' '
+        # every possible state of the bar is rendered once, the bar is redrawn when it changes and the counter
+        # at most every min_interval seconds in between
+        rendered_bars = [f"{prefix}|{'#' * filled}{' ' * (bar_length - filled)}| " for filled in range(bar_length + 1)]
+        last_filled_length = -1
+        last_shown = 0.0
+
+        def show(curr):
+            nonlocal last_filled_length, last_shown
+            filled_length = bar_length * curr // count if count > 0 else bar_length
+            now = time.monotonic()
+            if filled_length == last_filled_length and curr != count and now - last_shown < min_interval:
+                return
+            last_filled_length = filled_length
+            last_shown = now
 
             if curr == count and suffix_control == True:
-                file.write(f"{prefix}|{filled}{unfilled}| {curr}/{count} {suffix}\r")
+                file.write(f"{rendered_bars[filled_length]}{curr}/{count} {suffix}\r")
             else:
-                file.write(f"{prefix}|{filled}{unfilled}| {curr}/{count}\r")
+                file.write(f"{rendered_bars[filled_length]}{curr}/{count}\r")
             file.flush()
 
         show(0)
@@ -339,26 +789,46 @@ class SequenceRetriever:
         file.flush()
 
 
-    def retrieve_past_SRA(self):
+    def retrieve_past_SRA(self, sra_candidates: list = None):
         '''
         Accesses the Agroseek MySQL database (SRA_record table) to retrieve all past SRA numbers. Used to check if the user had
-        retrieved a certain SRA number before to avoid duplication.
+        retrieved a certain SRA number before to avoid duplication. The rows are streamed with a server-side cursor.
+
+        :param sra_candidates: optional list of SRA numbers, only these will be looked up in the database
         '''
-        DATABASE = pymysql.connect(
-            host='xxx',
-            user = 'xxx',
-            passwd='xxx',
-            database='xxx',
-        )
+        with contextlib.closing(self._get_connection().cursor(pymysql.cursors.SSCursor)) as mycursor:
+            project_id = '*' # pending changes
+            sql_retrieve_sra = 'SELECT SRA FROM sra_table WHERE Project_ID=%s'
+            sql_params = [project_id]
+
+            if sra_candidates:
+                sql_retrieve_sra += f" AND SRA IN ({', '.join(['%s'] * len(sra_candidates))})"
+                sql_params.extend(sra_candidates)
 
-        mycursor = DATABASE.cursor()
+            mycursor.execute(sql_retrieve_sra, sql_params)
+            self.past_sra = {sra[0] for sra in mycursor}
 
-        project_id = '*' # pending changes
-        sql_retrieve_sra = f'SELECT SRA FROM sra_table WHERE Project_ID={project_id};'
-        mycursor.execute(sql_retrieve_sra)
-        self.past_sra = [sra[0] for sra in mycursor]
 
 
+    def _get_connection(self):
+        '''
+        Returns the connection to the Agroseek MySQL database. The connection is opened on first use and reused, it is
+        reconnected if the server dropped it in the meantime.
+
+        :return: the database connection
+        '''
+        if self._db_conn == None:
+            self._db_conn = pymysql.connect(
+                host='xxx',
+                user = 'xxx',
+                passwd='xxx',
+                database='xxx',
+            )
+        else:
+            self._db_conn.ping(reconnect=True)
+
+        return self._db_conn
+
 
     def run_retriever(self, verify_input=False, validate_data=False):
         '''
@@ -369,21 +839,22 @@ class SequenceRetriever:
         '''
         start_time = time.time()
 
-        self.retrieve_past_SRA()
-        self.read_SRA_log()
+        try:
+            self.read_SRA_log()
+            self.retrieve_past_SRA(list(self.data_hash_table))
 
-        sra_list = []
-        for key in self.data_hash_table:
-            sra_list.append(key.strip())
-        if verify_input == True:
-            sra_list = self.verify_sra_format(sra_list)
+            sra_list = list(self.data_hash_table)
+            if verify_input == True:
+                sra_list = self.verify_sra_format(sra_list)
 
-        self.download_data(sra_list)
+            self.download_data(sra_list)
 
-        if validate_data == True:
-            self.validate_sra_data(sra_list)
+            if validate_data == True:
+                self.validate_sra_data(sra_list)
 
-        self.cleanup_files(sra_list)
+            self.cleanup_files()
+        finally:
+            self.close()
 
         time_spent = round((time.time() - start_time), 2)
         print(f"\nDownload Completed :) [{time_spent} seconds]")
@@ -409,39 +880,43 @@ class SRARetriever:
         Execution reference: wp-content/themes/twentyseventeen/uploadmeta_submit.php
         '''
         if len(sys_argv) > 1:
-            input_file = sys.argv[1]
+            input_file = sys_argv[1]
         if len(sys_argv) > 2:
-            project_id = sys.argv[2]
+            project_id = sys_argv[2]
         if len(sys_argv) > 3:
-            user_id = sys.argv[3]
+            user_id = sys_argv[3]
         if len(sys_argv) > 4:
             print(f"Warning: Too many arguments given to {__file__}")
 
         xl = pd.ExcelFile(input_file)
+        sheet_name = 'Metadata' if "Metadata" in xl.sheet_names else 0
 
-        if "Metadata" in xl.sheet_names:
-            df_metadata = pd.read_excel(input_file, index_col=0, sheet_name='Metadata')
-        else:
-            df_metadata = pd.read_excel(input_file, index_col=0)
-
-        df_metadata = df_metadata.apply(pd.to_numeric, errors='ignore')
+        # only the SRA number column is loaded, as plain strings
+        df_metadata = pd.read_excel(xl, sheet_name=sheet_name, usecols=["NCBI_SRA_number"], dtype=str)
 
-        SRA_list = df_metadata["NCBI_SRA_number"].to_string(index=False).strip().split('\n')
-        if SRA_list[0].startswith("SRR") != 1:
+        sra_series = df_metadata["NCBI_SRA_number"].dropna().str.strip()
+        SRA_list = sra_series[sra_series != ""].tolist()
+        if len(SRA_list) > 0 and _SRA_RE.fullmatch(SRA_list[0].upper()) == None: # skips the description row of the metadata template
             SRA_list = SRA_list[1:]
 
         with open(os.path.join(self.log_file_path, self.log_file_name), "w", encoding="utf-8") as file_ptr:
-            for SRA in SRA_list:
-                file_ptr.write(f"{SRA}\t{project_id}\t{user_id}\n")
+            file_ptr.writelines(f"{SRA}\t{project_id}\t{user_id}\n" for SRA in SRA_list)
 
 
 # Driver Code
 if __name__ == "__main__":
+    # --no-cache forces a fresh vdb-dump probe for every SRA number, --ena downloads the .fastq files from ENA where available
+    use_probe_cache = "--no-cache" not in sys.argv
+    use_ena = "--ena" in sys.argv
+    sys_argv = [arg for arg in sys.argv if arg not in ("--no-cache", "--ena")]
+
     SRARetr = SRARetriever()
-    SRARetr.retrieve_SRA(sys.argv)
+    SRARetr.retrieve_SRA(sys_argv)
 
-    SeqRetr = SequenceRetriever()
-    SeqRetr.run_retriever(verify_input=True, validate_data=True)
+    with SequenceRetriever() as SeqRetr:
+        SeqRetr.use_probe_cache = use_probe_cache
+        SeqRetr.use_ena = use_ena
+        SeqRetr.run_retriever(verify_input=True, validate_data=True)
 
 
 
@@ -26,8 +26,32 @@ import sys
 import time
 import datetime
 import subprocess
+import concurrent.futures
 import pandas as pd
 
+_SRA_RE = re.compile(r"(?:SRR|ERR)[0-9]+") # i.e. SRR1568808
+# every line of the raw vdb-validate output that does not end like a success ("md5 ok", "reads", "is consistent"),
+# \r\n line endings are accepted as the bytes are not translated like text mode output
+_BAD_LINE_RE = re.compile(rb"^(?!.*(?:[a-zA-Z0-9] ok| reads|is consistent)\r?$).*$", re.IGNORECASE | re.MULTILINE)
+
+_error_time = (None, "") # (second, formatted time) of the last logged error
+
+
+def _format_error_time() -> str:
+    '''
+    Returns the current time as written to the error logs. The formatted time is cached and only reformatted
+    once the second changes, as errors are usually logged in bursts.
+
+    :return: the current time formatted as %Y-%m-%d %H:%M:%S
+    :rtype: str
+    '''
+    global _error_time
+    now = int(time.time())
+    if _error_time[0] != now:
+        _error_time = (now, datetime.datetime.fromtimestamp(now).strftime('%Y-%m-%d %H:%M:%S'))
+    return _error_time[1]
+
+
 class SequenceRetriever:
     '''
     Class responsible for retrieving the sequence data and verifying the validity of the .sra files
@@ -36,17 +60,25 @@ class SequenceRetriever:
     '''
 
     def __init__(self):
-        self.dir_path = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'SRA-Numbers') # log file path
-        self.sra_toolkit_path = '~/sra_toolkit/sratoolkit.2.11.0-centos_linux64/bin' # SRA Toolkit path
+        self._base_dir = os.path.dirname(os.path.realpath(__file__)) # directory of this script
+        self.dir_path = os.path.join(self._base_dir, 'SRA-Numbers') # log file path
+        self.sra_toolkit_path = os.path.expanduser('~/sra_toolkit/sratoolkit.2.11.0-centos_linux64/bin') # SRA Toolkit path
 
         self.output_dir = "raw_sequence_data" # sequence data output directory name
+        self._output_abs = os.path.join(self._base_dir, self.output_dir) # absolute path of the output directory
         self.errorLogFilename = "error-log.tsv"
         self.SRALogFilename = "sra-log"
+        self.max_prefetch_workers = 4 # maximum number of concurrent prefetch calls
+        self.max_dump_workers = 2 # maximum number of concurrent fasterq-dump processes, the cores are split between them
+        self.dump_timeout = 12 * 60 * 60 # seconds before a hung fasterq-dump process is killed
+        self.max_validate_workers = 8 # maximum number of concurrent vdb-validate processes
 
         self.data_hash_table = {}
 
-        self.prefetch_access_denied_sra = []
-        self.prefetch_access_failed_sra = []
+        self.prefetch_access_denied_sra = set()
+        self.prefetch_access_failed_sra = set()
+
+        self._log_files = {} # error log file name -> buffered file opened in append mode
 
 
 
@@ -56,22 +88,52 @@ class SequenceRetriever:
 
         :param sra_list: a list of SRA accession numbers to retrieve to raw sequence data of
         '''
-        for sra_num in sra_list:
+        os.makedirs(self.output_dir, exist_ok=True) # also holds the fasterq-dump temporary files
 
-            curr_time = time.strftime("%Y-%m-%d|%H:%M:%S")
+        good_list = []
+        for sra_num in sra_list:
 
             print('\n\n')
-            vdb_dump_output = subprocess.getoutput(f"{self.sra_toolkit_path}/vdb-dump --info {sra_num}")
+            vdb_dump_output = subprocess.run([f"{self.sra_toolkit_path}/vdb-dump", "--info", sra_num],
+                                             stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True).stdout.rstrip('\n')
             if self.check_proccess_output(sra_num, "vdb-dump", vdb_dump_output) == -1:
                 for line in vdb_dump_output.split('\n'):
                     print(line)
-            else: continue
+                good_list.append(sra_num)
+
+        # each SRA is handed to the dump pool as soon as its prefetch call returns, so downloads and conversions overlap
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.max_dump_workers) as dump_pool, \
+             concurrent.futures.ThreadPoolExecutor(max_workers=self.max_prefetch_workers) as prefetch_pool:
+            futures = {prefetch_pool.submit(self.prefetch_one, sra_num): sra_num for sra_num in good_list}
+            for future in concurrent.futures.as_completed(futures):
+                future.result()
+                dump_pool.submit(self.dump_one, futures[future])
+
+
+    def prefetch_one(self, sra_num: str):
+        '''
+        Prefetches the .sra file of a single SRA number.
+
+        :param sra_num: SRA number to be prefetched
+        '''
+        subprocess.run([f"{self.sra_toolkit_path}/prefetch", "-p", sra_num], check=False)
 
-            subprocess.run(f"{self.sra_toolkit_path}/prefetch -p {sra_num}", shell=True)
 
-            print(f"Converting {sra_num}.sra to {sra_num}.fastq...")
-            subprocess.run(f"{self.sra_toolkit_path}/fasterq-dump --split-files -O {self.output_dir}/{sra_num} \
-                ./{sra_num}/{sra_num}.sra -p", shell=True)
+    def dump_one(self, sra_num: str):
+        '''
+        Converts the prefetched .sra file of a single SRA number to .fastq files with fasterq-dump.
+
+        :param sra_num: SRA number to be converted
+        '''
+        print(f"Converting {sra_num}.sra to {sra_num}.fastq...")
+        try:
+            subprocess.run([f"{self.sra_toolkit_path}/fasterq-dump", "--split-files", "-e", str(max(1, (os.cpu_count() or 1) // self.max_dump_workers)),
+                            "-t", self.output_dir, "-O", os.path.join(self.output_dir, sra_num),
+                            os.path.join(sra_num, f"{sra_num}.sra"), "-p"], check=False, timeout=self.dump_timeout)
+        except subprocess.TimeoutExpired:
+            print(f"Error: fasterq-dump for {sra_num} did not finish within {self.dump_timeout} seconds and was stopped.")
+        except OSError as e:
+            print(f"Error: fasterq-dump failed to start for {sra_num}: {e}")
 
 
     def verify_sra_format(self, sra_input: list) -> list:
@@ -89,7 +151,7 @@ class SequenceRetriever:
         for sra_num in sra_input:
             sra_num = sra_num.strip().replace('\n', '')
 
-            if re.match("^(SRR|ERR)[0-9]+$", sra_num.upper()): # i.e. SRR1568808
+            if _SRA_RE.fullmatch(sra_num.upper()) != None:
                 correct_data.append(sra_num)
             else:
                 incorrect_data.append(sra_num)
@@ -114,16 +176,13 @@ class SequenceRetriever:
         errors = []
         validation = True
 
-        for sra_num in self.progress_bar(sra_input_list, prefix="Validating SRA Data: ", bar_length=50):
-            result = subprocess.getoutput(f'{self.sra_toolkit_path}/vdb-validate {sra_num}')
-            result = result.split('\n')
-
-            for line in result:
-                if re.search("[a-zA-Z0-9] ok$", line, re.IGNORECASE) != None \
-                    or re.search(" reads$", line, re.IGNORECASE) != None \
-                    or re.search("is consistent$", line, re.IGNORECASE) != None:
-                    continue
-                else:
+        # the vdb-validate calls run concurrently, their output is classified here as each call finishes
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.max_validate_workers) as validate_pool:
+            futures = [validate_pool.submit(self._validate_one, sra_num) for sra_num in sra_input_list]
+            for future in self.progress_bar(concurrent.futures.as_completed(futures), prefix="Validating SRA Data: ", bar_length=50, count=len(futures)):
+                sra_num, result = future.result()
+                for bad_line in _BAD_LINE_RE.finditer(result):
+                    line = bad_line.group(0).decode("utf-8", errors="replace").rstrip("\r")
                     err = ""
                     if sra_num in self.prefetch_access_denied_sra:
                         err = "Project is private: Access Denied (403)"
@@ -146,6 +205,20 @@ class SequenceRetriever:
         return validation
 
 
+    def _validate_one(self, sra_num: str) -> tuple:
+        '''
+        Runs vdb-validate on a single SRA number.
+
+        :param sra_num: SRA number to be validated
+        :return: a tuple of the SRA number and the vdb-validate output as bytes, without the trailing newline
+        :rtype: tuple
+        '''
+        # the output is kept as bytes and the failed lines are found in a single scan over it
+        result = subprocess.run([f"{self.sra_toolkit_path}/vdb-validate", sra_num],
+                                stdout=subprocess.PIPE, stderr=subprocess.STDOUT).stdout.rstrip(b'\r\n')
+        return sra_num, result
+
+
     def check_proccess_output(self, sra_num: str, process: str, process_output: str) -> int:
         '''
         Function for identifying the process's error. Determines whether a vdb-dump failure is caused by invalid
@@ -163,14 +236,14 @@ class SequenceRetriever:
                 and re.search("( 403 )", process_output[0], re.IGNORECASE) != None:
 
                 print(f'Error: Access denied for {sra_num}. (403)')
-                self.prefetch_access_denied_sra.append(sra_num)
+                self.prefetch_access_denied_sra.add(sra_num)
                 return 403
 
             elif re.search(" failed to resolve accession ", process_output[0], re.IGNORECASE) != None \
                 and re.search("( 404 )", process_output[0], re.IGNORECASE) != None:
 
                 print(f'Error: Failed to resolve accession number {sra_num}. (404)')
-                self.prefetch_access_failed_sra.append(sra_num)
+                self.prefetch_access_failed_sra.add(sra_num)
                 return 404
 
         elif process == 'prefetch':
@@ -191,19 +264,12 @@ class SequenceRetriever:
         :param error_message: a message explaining what the error is (the error generated by a certain command)
         :param error_id: error code/name used to identify the error
         '''
+        errorTime = _format_error_time()
+        row = "\t".join((errorTime, sra_num, *self.data_hash_table[sra_num], error_message)) + "\n"
+        row = row.encode("utf-8")
+
         # Default Error Log (all errors will be logged)
-        with open(os.path.join(self.dir_path, self.errorLogFilename), "a+", encoding="utf-8") as file_ptr: 
-            label = "Error_Time\tSRA_Accession_Number\tProject_ID\tUser_ID\tError_Reason\n"
-            file_ptr.seek(0)
-            firstline = file_ptr.readline()
-            if firstline != label:
-                file_ptr.write(label)
-
-            errorTime = datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-            file_ptr.write(f"{errorTime}\t{sra_num}\t")
-            for data in self.data_hash_table[sra_num]:
-                file_ptr.write(f"{data}\t")
-            file_ptr.write(f'{error_message}\n')
+        self._get_log(self.errorLogFilename).write(row)
 
         # Separate Error Log
         error_log_file = ""
@@ -217,18 +283,33 @@ class SequenceRetriever:
             Please visit "{self.errorLogFilename}" for the error.')
 
         if len(error_log_file) > 0:
-            with open(os.path.join(self.dir_path, error_log_file), "a+", encoding="utf-8") as file_ptr: 
-                label = "Error_Time\tSRA_Accession_Number\tProject_ID\tUser_ID\tError_Reason\n"
-                file_ptr.seek(0)
-                firstline = file_ptr.readline()
-                if firstline != label:
-                    file_ptr.write(label)
+            self._get_log(error_log_file).write(row)
+
+
+    def _get_log(self, log_filename: str):
+        '''
+        Returns the buffered error log file, opened in append mode on first use and kept open until close()
+        is called. The header is written when the file is empty.
 
-                errorTime = datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-                file_ptr.write(f"{errorTime}\t{sra_num}\t")
-                for data in self.data_hash_table[sra_num]:
-                    file_ptr.write(f"{data}\t")
-                file_ptr.write(f'{error_message}\n')
+        :param log_filename: name of the error log file inside the log directory
+        :return: the error log file object
+        '''
+        if log_filename not in self._log_files:
+            file_ptr = open(os.path.join(self.dir_path, log_filename), "ab", buffering=65536)
+            if file_ptr.tell() == 0:
+                file_ptr.write(b"Error_Time\tSRA_Accession_Number\tProject_ID\tUser_ID\tError_Reason\n")
+            self._log_files[log_filename] = file_ptr
+
+        return self._log_files[log_filename]
+
+
+    def close(self):
+        '''
+        Flushes and closes all error log files opened by the retriever.
+        '''
+        for file_ptr in self._log_files.values():
+            file_ptr.close()
+        self._log_files.clear()
 
 
     def read_SRA_log(self):
@@ -236,8 +317,7 @@ class SequenceRetriever:
         Reads the SRA accession number log file and stores the data in a hash table.
         '''
         with open(os.path.join(self.dir_path, self.SRALogFilename), "r", encoding="utf-8") as file_ptr:
-            content = file_ptr.readlines()
-            for line in content:
+            for line in file_ptr:
                 values = line.replace("\n", "").split("\t")
                 self.data_hash_table[values[0].strip()] = values[1:len(values)]
 
@@ -257,24 +337,30 @@ class SequenceRetriever:
             if sra_num in self.prefetch_access_failed_sra or sra_num in self.prefetch_access_denied_sra:
                 continue
 
-            file_removal = subprocess.getoutput(f'rm {os.path.dirname(os.path.realpath(__file__))}/{sra_num}/{sra_num}.sra')
-            dir_removal = subprocess.getoutput(f'rmdir {os.path.dirname(os.path.realpath(__file__))}/{sra_num}')
-
-            if len(file_removal) > 0 or len(dir_removal) > 0:
+            try:
+                os.remove(os.path.join(self._base_dir, sra_num, f"{sra_num}.sra"))
+                os.rmdir(os.path.join(self._base_dir, sra_num))
+            except OSError:
                 errors.append(f"Removal for {sra_num}.sra failed.")
                 error_message = f"Error: {sra_num}.sra and/or the folder containing this file failed to be removed."
                 self.log_error(sra_num, error_message, "-1") 
 
         if len(self.prefetch_access_denied_sra) > 0:
-            for sra_num in self.prefetch_access_denied_sra:
-                empty_folder_removal = subprocess.getoutput(f'rmdir {os.path.dirname(os.path.realpath(__file__))}/{self.output_dir}/{sra_num}')
+            for sra_num in sorted(self.prefetch_access_denied_sra):
+                try:
+                    os.rmdir(os.path.join(self._output_abs, sra_num))
+                except OSError:
+                    pass # the output folder is only created for some failures
 
                 error_message = "Incorrect SRA: access denied (403)"
                 self.log_error(sra_num, error_message, "403")
 
         if len(self.prefetch_access_failed_sra) > 0:
-            for sra_num in self.prefetch_access_failed_sra:
-                empty_folder_removal = subprocess.getoutput(f'rmdir {os.path.dirname(os.path.realpath(__file__))}/{self.output_dir}/{sra_num}')
+            for sra_num in sorted(self.prefetch_access_failed_sra):
+                try:
+                    os.rmdir(os.path.join(self._output_abs, sra_num))
+                except OSError:
+                    pass # the output folder is only created for some failures
 
                 error_message = "Incorrect SRA: failed to resolve accession (404)"
                 self.log_error(sra_num, error_message, "404")
@@ -283,7 +369,7 @@ class SequenceRetriever:
             print(e)
 
 
-    def progress_bar(self, input, prefix="", suffix="", suffix_control=False, bar_length=50, file=sys.stdout):
+    def progress_bar(self, input, prefix="", suffix="", suffix_control=False, bar_length=50, file=sys.stdout, count=None, min_interval=0.1):
         '''Light-weight progress bar (generator)
 
         :param input: list/range input to be iterated over
@@ -292,19 +378,32 @@ class SequenceRetriever:
         :param suffix control: boolean to whether the suffix should be printed
         :param bar_length: the progress bar's length
         :param file: display/storage method
+        :param count: number of items in the input, required when the input has no len() (i.e. a generator)
+        :param min_interval: minimum number of seconds between two redraws that only update the counter
         '''
 
-        count = len(input)
-        def show(curr):
-            filled_length = int(bar_length * curr / count)
+        if count == None:
+            count = len(input)
 
-            filled = filled_length * '#'
-            unfilled = (bar_length - filled_length) * ' '
+        # every possible state of the bar is rendered once, the bar is redrawn when it changes and the counter
+        # at most every min_interval seconds in between
+        rendered_bars = [f"{prefix}|{'#' * filled}{' ' * (bar_length - filled)}| " for filled in range(bar_length + 1)]
+        last_filled_length = -1
+        last_shown = 0.0
+
+        def show(curr):
+            nonlocal last_filled_length, last_shown
+            filled_length = bar_length * curr // count if count > 0 else bar_length
+            now = time.monotonic()
+            if filled_length == last_filled_length and curr != count and now - last_shown < min_interval:
+                return
+            last_filled_length = filled_length
+            last_shown = now
 
             if curr == count and suffix_control == True:
-                file.write(f"{prefix}|{filled}{unfilled}| {curr}/{count} {suffix}\r")
+                file.write(f"{rendered_bars[filled_length]}{curr}/{count} {suffix}\r")
             else:
-                file.write(f"{prefix}|{filled}{unfilled}| {curr}/{count}\r")
+                file.write(f"{rendered_bars[filled_length]}{curr}/{count}\r")
             file.flush()
 
         show(0)
@@ -325,20 +424,23 @@ class SequenceRetriever:
         '''
         start_time = time.time()
 
-        self.read_SRA_log()
+        try:
+            self.read_SRA_log()
 
-        sra_list = []
-        for key in self.data_hash_table:
-            sra_list.append(key.strip())
-        if verify_input == True:
-            sra_list = self.verify_sra_format(sra_list)
+            sra_list = []
+            for key in self.data_hash_table:
+                sra_list.append(key.strip())
+            if verify_input == True:
+                sra_list = self.verify_sra_format(sra_list)
 
-        self.download_data(sra_list)
+            self.download_data(sra_list)
 
-        if validate_data == True:
-            self.validate_sra_data(sra_list)
+            if validate_data == True:
+                self.validate_sra_data(sra_list)
 
-        self.cleanup_files(sra_list)
+            self.cleanup_files(sra_list)
+        finally:
+            self.close()
 
         time_spent = round((time.time() - start_time), 2)
         print(f"\nDownload Completed :) [{time_spent} seconds]")
@@ -373,21 +475,18 @@ class SRARetriever:
             print(f"Warning: Too many arguments given to {__file__}")
 
         xl = pd.ExcelFile(input_file)
+        sheet_name = 'Metadata' if "Metadata" in xl.sheet_names else 0
 
-        if "Metadata" in xl.sheet_names:
-            df_metadata = pd.read_excel(input_file, index_col=0, sheet_name='Metadata')
-        else:
-            df_metadata = pd.read_excel(input_file, index_col=0)
-            
-        df_metadata = df_metadata.apply(pd.to_numeric, errors='ignore')
+        # only the SRA number column is loaded, as plain strings
+        df_metadata = pd.read_excel(xl, sheet_name=sheet_name, usecols=["NCBI_SRA_number"], dtype=str)
 
-        SRA_list = df_metadata["NCBI_SRA_number"].to_string(index=False).strip().split('\n')
-        if SRA_list[0].startswith("SRR") != 1:
+        sra_series = df_metadata["NCBI_SRA_number"].dropna().str.strip()
+        SRA_list = sra_series[sra_series != ""].tolist()
+        if len(SRA_list) > 0 and _SRA_RE.fullmatch(SRA_list[0].upper()) == None: # skips the description row of the metadata template
             SRA_list = SRA_list[1:]
 
         with open(os.path.join(self.log_file_path, self.log_file_name), "w", encoding="utf-8") as file_ptr:
-            for SRA in SRA_list:
-                file_ptr.write(f"{SRA}\t{project_id}\t{user_id}\n")
+            file_ptr.writelines(f"{SRA}\t{project_id}\t{user_id}\n" for SRA in SRA_list)
 
 
 # Driver Code